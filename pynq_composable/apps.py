@@ -438,8 +438,8 @@ class Filter2DApp(PipelineApp):
         ----------
         bitfile_name : str
             Bitstream filename
-        source : str (optional)
-            Input video source. Valid values ['HDMI', 'MIPI']
+        source : VSource (optional)
+            Input video source. Valid values [VSource.HDMI, VSource.MIPI]
         """
 
         super().__init__(bitfile_name=bitfile_name, source=source)
@@ -487,8 +487,8 @@ class LutApp(PipelineApp):
         ----------
         bitfile_name : str
             Bitstream filename
-        source : str (optional)
-            Input video source. Valid values ['HDMI', 'MIPI']
+        source : VSource (optional)
+            Input video source. Valid values [VSource.HDMI, VSource.MIPI]
         """
 
         super().__init__(bitfile_name=bitfile_name, source=source)
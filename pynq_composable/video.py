@@ -3,9 +3,12 @@
 # SPDX-License-Identifier: BSD-3-Clause
 
 import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 from enum import Enum, auto
 import json
+import numpy as np
 import os
 from pynq import Overlay
 from pynq.lib.video import DrmDriver, VideoMode, PIXEL_RGB
@@ -14,6 +17,7 @@ from pynq.ps import CPU_ARCH, ZU_ARCH, ZYNQ_ARCH
 from time import sleep
 import threading
 from typing import Union
+import warnings
 
 
 __author__ = "Mario Ruiz"
@@ -24,6 +28,56 @@ __email__ = "pynq_support@xilinx.com"
 """Collection of classes to manage different video sources"""
 
 
+# Hardware accelerated decode is requested where OpenCV supports it,
+# FFmpeg falls back to software decode if no accelerator is available
+if hasattr(cv2, 'VIDEO_ACCELERATION_ANY'):
+    _HWDECODE = ([cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY],)
+else:
+    _HWDECODE = ()
+
+_MJPG_FOURCC = cv2.VideoWriter_fourcc(*'MJPG')
+
+# CPUs the video threads run on, CPU 0 is left to the Jupyter kernel. All
+# video threads share these CPUs, on a dual core Zynq that is only CPU 1
+if hasattr(os, 'sched_getaffinity'):
+    _VIDEO_CPUS = os.sched_getaffinity(0) - {0}
+else:
+    _VIDEO_CPUS = set()
+
+
+def _pin(thread):
+    """Pin a started thread to the video CPUs if the platform allows it
+
+    Pinning is only a scheduling hint, hence a failure, e.g. the CPUs are no
+    longer allowed after a cpuset change or a CPU hotplug, is ignored
+    """
+
+    if _VIDEO_CPUS:
+        try:
+            os.sched_setaffinity(thread.native_id, _VIDEO_CPUS)
+        except OSError:
+            pass
+
+
+_copypool = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="video-copy",
+    initializer=lambda: _pin(threading.current_thread()))
+
+
+def _copyframe(dst, src):
+    """Copy src into dst using two cores
+
+    The bottom half of the rows is copied by a pool worker while the calling
+    thread copies the top half. The halves do not overlap and numpy releases
+    the GIL while copying
+    """
+
+    half = src.shape[0] // 2
+    future = _copypool.submit(np.copyto, dst[half:], src[half:])
+    np.copyto(dst[:half], src[:half])
+    future.result()
+
+
 class VSource(Enum):
     """Suported input video sources"""
 
@@ -39,6 +93,9 @@ class VSink(Enum):
     DP = auto()
 
 
+_VALID_SOURCES = frozenset({VSource.HDMI, VSource.MIPI})
+
+
 class _DisplayPort(DrmDriver):
     """Subclass of DisplayPort that works in a thread"""
 
@@ -73,6 +130,87 @@ class _DisplayPort(DrmDriver):
             frame.pointer = None
 
 
+class _LatestFrameSlot:
+    """Frame pool that hands the latest frame from a producer thread to a
+    consumer thread
+
+    The producer fills ``back`` and publishes it with ``put``, the consumer
+    takes the most recent published frame with ``get`` and hands it back
+    with ``release`` once it is written. A pynq video sink keeps reading a
+    written frame until the next one becomes active, which is only
+    guaranteed once the following ``writeframe`` returns, hence the last
+    two released frames stay out of rotation and the producer never writes
+    into a frame the sink may still read. A dropping slot discards frames
+    the consumer was too slow to take, otherwise the producer waits for the
+    consumer, which bounds the prefetch to the published and the back frames
+    """
+
+    _hold = 2
+    size = _hold + 3
+
+    def __init__(self, frames, drop=True):
+        """Return a slot that cycles through preallocated frames
+
+        Parameters
+        ----------
+        frames : list
+            ``size`` frames with the same layout
+        drop : bool (optional)
+            Discard published frames the consumer did not take
+        """
+
+        if len(frames) != self.size:
+            raise ValueError("{} frames are needed, got {}"
+                             .format(self.size, len(frames)))
+        self._free = deque(frames)
+        self._written = deque()
+        self.back = self._free.popleft()
+        self._middle = None
+        self._drop = drop
+        self._cond = threading.Condition()
+
+    def put(self, timeout=None):
+        """Publish the back frame, swapping in a new back frame
+
+        Returns False, without publishing, if the slot does not drop frames
+        and the consumer does not take the previous frame within timeout
+        seconds
+        """
+
+        with self._cond:
+            if not self._drop and not self._cond.wait_for(
+                    lambda: self._middle is None, timeout):
+                return False
+            if self._middle is not None:
+                self._free.append(self._middle)
+            self._middle = self.back
+            self.back = self._free.popleft()
+            self._cond.notify()
+        return True
+
+    def get(self, timeout=None):
+        """Take the latest published frame
+
+        Returns None if no new frame is published within timeout seconds
+        """
+
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._middle is not None,
+                                       timeout):
+                return None
+            frame, self._middle = self._middle, None
+            self._cond.notify()
+            return frame
+
+    def release(self, frame):
+        """Hand back a frame taken with ``get`` once it is written"""
+
+        with self._cond:
+            self._written.append(frame)
+            if len(self._written) > self._hold:
+                self._free.append(self._written.popleft())
+
+
 class PLPLVideo:
     """PLPLVideo class
 
@@ -86,12 +224,11 @@ class PLPLVideo:
         ----------
         ol : pynq.Overlay
             Overlay object
-        source : str (optional)
+        source : VSource (optional)
             Input video source. Valid values [VSource.HDMI, VSource.MIPI]
         """
 
-        VSourceources = [VSource.HDMI, VSource.MIPI]
-        if source not in VSourceources:
+        if source not in _VALID_SOURCES:
             raise ValueError("{} is not supported".format(source))
         elif ol.device.name != 'Pynq-ZU' and source != VSource.HDMI:
             raise ValueError("Device {} only supports {} as input source "
@@ -180,12 +317,11 @@ class PLDPVideo:
         ----------
         ol : pynq.Overlay
             Overlay object
-        source : str (optional)
+        source : VSource (optional)
             Input video source. Valid values [VSource.HDMI, VSource.MIPI]
         """
 
-        VSourceources = [VSource.HDMI, VSource.MIPI]
-        if source not in VSourceources:
+        if source not in _VALID_SOURCES:
             raise ValueError("{} is not supported".format(source))
 
         if CPU_ARCH != ZU_ARCH:
@@ -196,7 +332,8 @@ class PLDPVideo:
         self._started = None
         self._pause = None
         self._dp = _DisplayPort()
-        self._running = None
+        self._stopped = threading.Event()
+        self._stopped.set()
 
         if self._source == VSource.HDMI:
             self._source_in = ol.video.hdmi_in
@@ -227,9 +364,8 @@ class PLDPVideo:
     def stop(self):
         """Stop the HDMI"""
         if self._started:
-            self._running = False
-            while self._thread.is_alive():
-                sleep(0.05)
+            self._stopped.set()
+            self._thread.join()
             self._source_in.close()
             self._dp.stop()
             self._started = False
@@ -238,8 +374,9 @@ class PLDPVideo:
     def _tie(self):
         """Mirror the video stream input to an output channel"""
 
-        self._thread = threading.Thread(target=self._tievdma, daemon=True)
-        self._running = True
+        self._thread = threading.Thread(target=self._tievdma, daemon=True,
+                                        name="PLDPVideo-tie")
+        self._stopped.clear()
 
         try:
             self._thread.start()
@@ -247,21 +384,27 @@ class PLDPVideo:
             import traceback
             print(traceback.format_exc())
             raise ValueError("error starting new thread")
+        _pin(self._thread)
 
     def _tievdma(self):
         """Threaded method to implement tie"""
-        while self._running:
+
+        stopped = self._stopped.is_set
+        newframe = self._dp.newframe
+        readframe = self._source_in.readframe
+        writeframe = self._dp.writeframe
+        while not stopped():
             try:
-                dpframe = self._dp.newframe()
-                dpframe[:] = self._source_in.readframe()
-                self._dp.writeframe(dpframe)
+                dpframe = newframe()
+                dpframe[:] = readframe()
+                writeframe(dpframe)
                 sleep(0.07)
             except Exception as e:
                 print('An exception occurred: {}'.format(e))
                 import traceback
                 import logging
                 logging.error(traceback.format_exc())
-                self._running = False
+                self._stopped.set()
 
     @property
     def modein(self):
@@ -279,7 +422,7 @@ class OpenCVPLVideo:
     """Wrapper for a OpenCV video stream pipeline that sinks on PL"""
 
     def __init__(self, ol: Overlay, filename: Union[int, str],
-                 mode=VideoMode(1280, 720, 24, 60)):
+                 mode: VideoMode = None):
         """ Returns a OpenCVPL object
 
         Parameters
@@ -287,8 +430,8 @@ class OpenCVPLVideo:
         filename : [int, str]
             video filename
 
-        mode : VideoMode
-            video configuration
+        mode : VideoMode (optional)
+            video configuration. Default 1280x720 24-bit at 60 fps
         """
 
         if not isinstance(filename, str) and not isinstance(filename, int):
@@ -299,10 +442,13 @@ class OpenCVPLVideo:
             raise RuntimeError("File {} does not exists".format(filename))
 
         self._file = filename
+        self._webcam = isinstance(filename, int)
+        self._grab = self._grab_latest if self._webcam else self._grab_next
         self._hdmi_out = ol.video.hdmi_out
         self._videoIn = None
-        self.mode = mode
-        self._running = None
+        self.mode = mode if mode else VideoMode(1280, 720, 24, 60)
+        self._stopped = threading.Event()
+        self._stopped.set()
         self._started = None
 
         if ol.device.name == 'Pynq-ZU':
@@ -322,22 +468,36 @@ class OpenCVPLVideo:
                 ol.hdmi_tx_control.write(0, 1)
 
     def _configure(self):
-        """Add cv2.CAP_V4L2 to make sure V4L2 libraries are used"""
-        if isinstance(self._file, int):
-            self._file += cv2.CAP_V4L2
-        self._videoIn = cv2.VideoCapture(self._file)
-        if not self._videoIn:
+        """Use cv2.CAP_V4L2 to make sure V4L2 libraries are used for webcams
+
+        Files are opened with the FFmpeg backend and hardware accelerated
+        decode, if FFmpeg can't open the file the default backend is used
+        """
+        # A device or hardware decoder session is only freed on release
+        if self._videoIn:
+            self._videoIn.release()
+        if self._webcam:
+            self._videoIn = cv2.VideoCapture(self._file, cv2.CAP_V4L2)
+        else:
+            self._videoIn = cv2.VideoCapture(self._file, cv2.CAP_FFMPEG,
+                                             *_HWDECODE)
+            if not self._videoIn.isOpened():
+                self._videoIn = cv2.VideoCapture(self._file)
+        if not self._videoIn.isOpened():
             raise RuntimeError("OpenCV can't open {}".format(self._file))
         self._videoIn.set(cv2.CAP_PROP_FRAME_WIDTH, self.mode.width)
         self._videoIn.set(cv2.CAP_PROP_FRAME_HEIGHT, self.mode.height)
-        fourcc = int(self._videoIn.get(cv2.CAP_PROP_FOURCC))
-        mode = \
-            fourcc.to_bytes((fourcc.bit_length() + 7) // 8, 'little').decode()
-        if isinstance(self._file, int):
-            if mode != 'MJPG':
-                self._videoIn.set(cv2.CAP_PROP_FOURCC,
-                                  cv2.VideoWriter_fourcc('M', 'J', 'P', 'G'))
+        if self._webcam:
+            if int(self._videoIn.get(cv2.CAP_PROP_FOURCC)) != _MJPG_FOURCC:
+                self._videoIn.set(cv2.CAP_PROP_FOURCC, _MJPG_FOURCC)
+            # Queue a single frame in the driver to avoid stale frames
+            if not self._videoIn.set(cv2.CAP_PROP_BUFFERSIZE, 1):
+                warnings.warn("Webcam {} refused a single frame buffer, "
+                              "frames may be stale".format(self._file))
         self._videoIn.set(cv2.CAP_PROP_FPS, self.mode.fps)
+        # Frames to grab without decoding when the source outpaces the sink
+        fps = self._videoIn.get(cv2.CAP_PROP_FPS)
+        self._skip = max(int(fps // self.mode.fps) - 1, 0)
 
         f_reso = (int(self._videoIn.get(cv2.CAP_PROP_FRAME_WIDTH)),
                   int(self._videoIn.get(cv2.CAP_PROP_FRAME_HEIGHT)))
@@ -355,16 +515,16 @@ class OpenCVPLVideo:
             self._hdmi_out.start()
             self._tie()
             self._started = True
-        elif not self._running:
+        elif self._stopped.is_set():
             self._tie()
 
     def stop(self):
         """Stop the video stream"""
 
         if self._videoIn and self._started:
-            self._running = False
-            while self._thread.is_alive():
-                sleep(0.05)
+            self._stopped.set()
+            for thread in self._threads:
+                thread.join()
             self._videoIn.release()
             self._hdmi_out.stop()
             self._videoIn = None
@@ -376,61 +536,153 @@ class OpenCVPLVideo:
         if not self._videoIn:
             raise SystemError("The stream is not started")
 
-        if self._running:
-            self._running = False
+        if not self._stopped.is_set():
+            self._stopped.set()
+            for thread in self._threads:
+                thread.join()
 
     def close(self):
         """Uninitialise the drivers, stopping the pipeline beforehand"""
 
         self.stop()
 
-    def readframe(self):
-        """Read an image from the video stream"""
+    def readframe(self, frame=None):
+        """Read an image from the video stream
+
+        Parameters
+        ----------
+        frame : numpy.ndarray (optional)
+            Preallocated buffer OpenCV decodes the image into. If the
+            layout does not match, OpenCV returns a new array instead
+        """
 
-        for _ in range(5):
-            ret, frame = self._videoIn.read()
-            if not ret:
+        for attempt in range(5):
+            if self._grab():
+                ret, image = self._videoIn.retrieve(frame)
+                if ret:
+                    return image
+            # Seek files back to the start on end of file, reopening the
+            # source is only needed when that does not recover the stream
+            if attempt or self._webcam or \
+                    not self._videoIn.set(cv2.CAP_PROP_POS_FRAMES, 0):
                 self._configure()
-            else:
-                return frame
         raise RuntimeError("OpenCV can't rewind {}".format(self._file))
 
+    def _grab_next(self):
+        """Grab the next video file frame that is shown
+
+        Frames the sink is too slow to show are grabbed without decoding them
+        """
+
+        for _ in range(self._skip):
+            self._videoIn.grab()
+        return self._videoIn.grab()
+
+    def _grab_latest(self):
+        """Grab the most recent webcam frame
+
+        If the driver accepted a single frame buffer (CAP_PROP_BUFFERSIZE),
+        the grabbed frame is at most one frame period old. Otherwise it can
+        be as old as the driver queue is deep
+        """
+
+        return self._videoIn.grab()
+
+    def _readinto(self, frame):
+        """Decode the next image from the video stream into frame"""
+
+        image = self.readframe(frame)
+        if image is not frame:
+            frame[:] = image
+
     def _tie(self):
-        """Mirror the video stream input to an output channel"""
+        """Mirror the video stream input to an output channel
+
+        Frames are decoded by a producer thread and written to the output
+        by a consumer thread, so decoding overlaps with the output waiting
+        for the next frame to be scheduled
+        """
 
         if not self._videoIn:
             raise SystemError("The stream is not started")
 
-        self._outframe = self._hdmi_out.newframe()
-        self._thread = threading.Thread(target=self._tievdma, daemon=True)
-        self._running = True
+        self._slot = _LatestFrameSlot(self._newframes(), drop=self._webcam)
+        self._threads = [
+            threading.Thread(target=self._producer_loop, daemon=True,
+                             name="OpenCV-capture"),
+            threading.Thread(target=self._consumer_loop, daemon=True,
+                             name="OpenCV-display")]
+        self._stopped.clear()
         try:
-            self._thread.start()
+            for thread in self._threads:
+                thread.start()
         except Exception:
             import traceback
             print(traceback.format_exc())
+            raise ValueError("error starting new thread")
+        for thread in self._threads:
+            _pin(thread)
 
-    def _tievdma(self):
-        """Threaded method to implement tie"""
+    def _newframes(self):
+        """Return the frames cycled by the producer and consumer"""
+
+        return [self._hdmi_out.newframe()
+                for _ in range(_LatestFrameSlot.size)]
 
-        while self._running:
-            self._outframe[:] = self.readframe()
-            self._hdmi_out.writeframe(self._outframe)
+    def _writeframe(self, frame):
+        """Write a decoded frame to the output"""
+
+        self._hdmi_out.writeframe(frame)
+
+    def _producer_loop(self):
+        """Threaded method that decodes frames into the slot
+
+        Webcam frames are published as they arrive, the latest one is shown.
+        Video files are decoded at most two frames ahead of the consumer
+        """
+
+        stopped = self._stopped.is_set
+        readinto = self._readinto
+        slot = self._slot
+        try:
+            while not stopped():
+                readinto(slot.back)
+                while not slot.put(timeout=0.1):
+                    if stopped():
+                        return
+        finally:
+            self._stopped.set()
+
+    def _consumer_loop(self):
+        """Threaded method that writes the latest decoded frame"""
+
+        stopped = self._stopped.is_set
+        get = self._slot.get
+        release = self._slot.release
+        writeframe = self._writeframe
+        try:
+            while not stopped():
+                frame = get(timeout=0.1)
+                if frame is not None:
+                    writeframe(frame)
+                    release(frame)
+        finally:
+            self._stopped.set()
 
 
 class OpenCVDPVideo(OpenCVPLVideo):
     """Wrapper for a webcam/file video pipeline streamed to DisplayPort"""
 
     def __init__(self, ol: Overlay, filename: Union[int, str],
-                 mode=VideoMode(1280, 720, 24, 60)):
+                 mode: VideoMode = None):
         """ Returns a OpenCVDP object
 
         Parameters
         ----------
         filename : [int, str]
             video filename
-        mode : VideoMode
-            webcam configuration
+        mode : VideoMode (optional)
+            webcam configuration. Default 1280x720 24-bit at 60 fps
         vdma : pynq.lib.video.dma.AxiVDMA
             Xilinx VideoDMA IP core
         """
@@ -443,14 +695,18 @@ class OpenCVDPVideo(OpenCVPLVideo):
             raise RuntimeError("File {} does not exists".format(filename))
 
         self._file = filename
+        self._webcam = isinstance(filename, int)
+        self._grab = self._grab_latest if self._webcam else self._grab_next
         self.vdma = ol.video.axi_vdma
-        self.mode = mode
+        self._videoIn = None
+        self.mode = mode if mode else VideoMode(1280, 720, 24, 60)
         self._dp = _DisplayPort()
         if self.vdma:
             self.vdma.writechannel.mode = self.mode
             self.vdma.readchannel.mode = self.mode
 
-        self._running = None
+        self._stopped = threading.Event()
+        self._stopped.set()
         self._started = None
 
     def start(self):
@@ -468,43 +724,27 @@ class OpenCVDPVideo(OpenCVPLVideo):
         """Stop video stream"""
 
         if self._started:
-            self._running = False
-            while self._thread.is_alive():
-                sleep(0.05)
+            self._stopped.set()
+            for thread in self._threads:
+                thread.join()
             self.vdma.writechannel.stop()
             self.vdma.readchannel.stop()
             self._dp.stop()
             self._started = False
 
-    def _tie(self):
-        """Mirror the video stream input to an output channel"""
-
-        if not self._videoIn:
-            raise SystemError("The stream is not started")
-
-        self._thread = threading.Thread(target=self._tievdma, daemon=True)
-        self._running = True
+    def _newframes(self):
+        """Return the VDMA frames cycled by the producer and consumer"""
 
-        try:
-            self._thread.start()
-        except Exception:
-            import traceback
-            print(traceback.format_exc())
-            raise ValueError("error starting new thread")
+        return [self.vdma.writechannel.newframe()
+                for _ in range(_LatestFrameSlot.size)]
 
-    def _tievdma(self):
-        """Threaded method to implement tie"""
+    def _writeframe(self, frame):
+        """Write a decoded frame to the VDMA and the processed one to DP"""
 
-        while self._running:
-            try:
-                fpgaframe = self.vdma.writechannel.newframe()
-                fpgaframe[:] = self.readframe()
-                self.vdma.writechannel.writeframe(fpgaframe)
-                dpframe = self._dp.newframe()
-                dpframe[:] = self.vdma.readchannel.readframe()
-                self._dp.writeframe(dpframe)
-            except RuntimeError:
-                raise RuntimeError("Can't start thread")
+        self.vdma.writechannel.writeframe(frame)
+        dpframe = self._dp.newframe()
+        _copyframe(dpframe, self.vdma.readchannel.readframe())
+        self._dp.writeframe(dpframe)
 
 
 class VideoStream:
@@ -526,7 +766,7 @@ class VideoStream:
         ----------
         ol : pynq.Overlay
             Overlay object
-        source : str (optional)
+        source : VSource (optional)
             Input video source. Valid values [VSource.HDMI, VSource.MIPI]
         """
 
@@ -0,0 +1,338 @@
+# Copyright (C) 2021 Xilinx, Inc
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+
+import cv2
+import numpy as np
+from pynq.lib.video import VideoMode
+from pynq_composable import video
+import pytest
+import threading
+import time
+from types import SimpleNamespace
+
+__author__ = "Mario Ruiz"
+__copyright__ = "Copyright 2021, Xilinx"
+__email__ = "pynq_support@xilinx.com"
+
+_mode = VideoMode(64, 48, 24, 30)
+
+
+class FakeCapture:
+    """Stand-in for cv2.VideoCapture playing a video file
+
+    Frame i is filled with the value i
+    """
+
+    def __init__(self, nframes=5, fps=30, seekable=True, buffersize=True):
+        self.nframes = nframes
+        self.buffersize = buffersize
+        self.fps = fps
+        self.seekable = seekable
+        self.opened = True
+        self.args = None
+        self.pos = 0
+        self.grabbed = None
+        self.retrieved = 0
+
+    def isOpened(self):
+        return self.opened
+
+    def grab(self):
+        if self.pos >= self.nframes:
+            return False
+        self.grabbed = self.pos
+        self.pos += 1
+        return True
+
+    def retrieve(self, image=None):
+        self.retrieved += 1
+        if image is None:
+            image = np.empty(_mode.shape, dtype=np.uint8)
+        image[:] = self.grabbed
+        return True, image
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            if not self.seekable:
+                return False
+            self.pos = int(value)
+        elif prop == cv2.CAP_PROP_BUFFERSIZE:
+            return self.buffersize
+        return True
+
+    def get(self, prop):
+        return {cv2.CAP_PROP_FPS: self.fps,
+                cv2.CAP_PROP_FRAME_WIDTH: _mode.width,
+                cv2.CAP_PROP_FRAME_HEIGHT: _mode.height}.get(prop, 0)
+
+    def release(self):
+        self.opened = False
+
+
+class FakeSink:
+    """Models pynq MM2S writeframe
+
+    writeframe blocks until the scheduled frame is active and then schedules
+    the new one, the active and scheduled frames are read by the hardware
+    """
+
+    def __init__(self, delay=0.002):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.writing = None
+        self.scheduled = None
+        self.active = None
+        self.values = []
+
+    def newframe(self):
+        return np.zeros(_mode.shape, dtype=np.uint8)
+
+    def writeframe(self, frame):
+        with self.lock:
+            self.writing = frame
+        time.sleep(self.delay)
+        with self.lock:
+            self.active, self.scheduled = self.scheduled, frame
+            self.values.append(int(frame[0, 0, 0]))
+
+    def in_use(self, frame):
+        with self.lock:
+            return any(frame is f for f in
+                       (self.writing, self.scheduled, self.active))
+
+    def configure(self, mode):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+@pytest.fixture
+def captures(monkeypatch):
+    """Captures handed out by cv2.VideoCapture, in order
+
+    Like a V4L2 device or a hardware decoder session, a capture can't be
+    opened while a previous one is still open
+    """
+
+    queue = []
+    handed = []
+
+    def videocapture(*args):
+        capture = queue.pop(0)
+        capture.args = args
+        if any(c.isOpened() for c in handed):
+            capture.opened = False
+        handed.append(capture)
+        return capture
+
+    monkeypatch.setattr(video.cv2, "VideoCapture", videocapture)
+    yield queue
+
+
+@pytest.fixture
+def opencvvideo(tmp_path, captures):
+    filename = tmp_path / "video.avi"
+    filename.touch()
+    ol = SimpleNamespace(video=SimpleNamespace(hdmi_out=FakeSink()),
+                         device=SimpleNamespace(name="Pynq-Z2"))
+    yield video.OpenCVPLVideo(ol, str(filename), _mode)
+
+
+@pytest.fixture
+def opencvwebcam(captures):
+    ol = SimpleNamespace(video=SimpleNamespace(hdmi_out=FakeSink()),
+                         device=SimpleNamespace(name="Pynq-Z2"))
+    yield video.OpenCVPLVideo(ol, 0, _mode)
+
+
+def _slot(drop=True):
+    frames = [np.zeros(1, dtype=np.uint8)
+              for _ in range(video._LatestFrameSlot.size)]
+    return video._LatestFrameSlot(frames, drop=drop)
+
+
+def test_slot_frames():
+    with pytest.raises(ValueError):
+        video._LatestFrameSlot([np.zeros(1)] * 3)
+
+
+def test_slot_get_timeout():
+    slot = _slot()
+    assert slot.get(timeout=0.01) is None
+
+
+def test_slot_drop():
+    slot = _slot()
+    for value in range(1, 4):
+        slot.back[:] = value
+        assert slot.put(timeout=0)
+    assert slot.get(timeout=0)[0] == 3
+    assert slot.get(timeout=0) is None
+
+
+def test_slot_blocking():
+    slot = _slot(drop=False)
+    slot.back[:] = 1
+    assert slot.put(timeout=0)
+    slot.back[:] = 2
+    assert not slot.put(timeout=0.01)
+    frame = slot.get(timeout=0)
+    assert frame[0] == 1
+    assert slot.put(timeout=0)
+    slot.release(frame)
+    assert slot.get(timeout=0)[0] == 2
+
+
+@pytest.mark.parametrize("drop", [True, False])
+def test_slot_back_not_in_use(drop):
+    frames = [np.zeros(_mode.shape, dtype=np.uint8)
+              for _ in range(video._LatestFrameSlot.size)]
+    slot = video._LatestFrameSlot(frames, drop=drop)
+    sink = FakeSink()
+    done = threading.Event()
+    violations = []
+
+    def consumer():
+        while not done.is_set():
+            frame = slot.get(timeout=0.01)
+            if frame is not None:
+                sink.writeframe(frame)
+                slot.release(frame)
+
+    thread = threading.Thread(target=consumer, daemon=True)
+    thread.start()
+    for value in range(300):
+        if sink.in_use(slot.back):
+            violations.append(value)
+        slot.back[:] = value % 256
+        while not slot.put(timeout=0.01):
+            pass
+        time.sleep(0.0005)
+    done.set()
+    thread.join()
+    assert sink.values
+    assert violations == []
+
+
+@pytest.mark.parametrize("fps, skip", [(30, 0), (60, 1), (120, 3), (0, 0)])
+def test_skip(opencvvideo, captures, fps, skip):
+    captures.append(FakeCapture(nframes=10, fps=fps))
+    opencvvideo._configure()
+    assert opencvvideo._skip == skip
+
+
+def test_readframe_skip(opencvvideo, captures):
+    capture = FakeCapture(nframes=10, fps=60)
+    captures.append(capture)
+    opencvvideo._configure()
+    assert [opencvvideo.readframe()[0, 0, 0] for _ in range(3)] == [1, 3, 5]
+    assert capture.retrieved == 3
+
+
+def _count_configure(opencvvideo, monkeypatch):
+    calls = []
+    configure = opencvvideo._configure
+
+    def counted():
+        calls.append(None)
+        configure()
+
+    monkeypatch.setattr(opencvvideo, "_configure", counted)
+    return calls
+
+
+def test_readframe_rewind_seek(opencvvideo, captures, monkeypatch):
+    captures.append(FakeCapture(nframes=2))
+    opencvvideo._configure()
+    calls = _count_configure(opencvvideo, monkeypatch)
+    values = [opencvvideo.readframe()[0, 0, 0] for _ in range(5)]
+    assert values == [0, 1, 0, 1, 0]
+    assert calls == []
+
+
+def test_readframe_rewind_seek_rejected(opencvvideo, captures, monkeypatch):
+    captures.extend([FakeCapture(nframes=2, seekable=False),
+                     FakeCapture(nframes=2, seekable=False)])
+    opencvvideo._configure()
+    calls = _count_configure(opencvvideo, monkeypatch)
+    values = [opencvvideo.readframe()[0, 0, 0] for _ in range(3)]
+    assert values == [0, 1, 0]
+    assert len(calls) == 1
+
+
+def test_reopen_file(opencvvideo, captures):
+    first = FakeCapture(nframes=1, seekable=False)
+    captures.extend([first, FakeCapture(nframes=1)])
+    opencvvideo._configure()
+    opencvvideo.readframe()
+    assert opencvvideo.readframe()[0, 0, 0] == 0
+    assert not first.isOpened()
+    assert opencvvideo._videoIn.args == \
+        (opencvvideo._file, cv2.CAP_FFMPEG, *video._HWDECODE)
+
+
+def test_readframe_rewind_stream_error(opencvvideo, captures, monkeypatch):
+    captures.extend([FakeCapture(nframes=0), FakeCapture(nframes=2)])
+    opencvvideo._configure()
+    calls = _count_configure(opencvvideo, monkeypatch)
+    assert opencvvideo.readframe()[0, 0, 0] == 0
+    assert len(calls) == 1
+
+
+def test_readframe_error(opencvvideo, captures):
+    captures.extend([FakeCapture(nframes=0) for _ in range(5)])
+    opencvvideo._configure()
+    with pytest.raises(RuntimeError):
+        opencvvideo.readframe()
+
+
+def test_webcam_buffersize(opencvwebcam, captures):
+    captures.append(FakeCapture(buffersize=False))
+    with pytest.warns(UserWarning, match="single frame buffer"):
+        opencvwebcam._configure()
+
+
+def test_reopen_webcam(opencvwebcam, captures):
+    first = FakeCapture(nframes=1)
+    captures.extend([first, FakeCapture(nframes=2)])
+    opencvwebcam._configure()
+    assert opencvwebcam.readframe()[0, 0, 0] == 0
+    assert opencvwebcam.readframe()[0, 0, 0] == 0
+    assert not first.isOpened()
+    assert opencvwebcam._videoIn.args == (0, cv2.CAP_V4L2)
+
+
+def test_pin_error(monkeypatch):
+    def setaffinity(pid, cpus):
+        raise OSError(22, "Invalid argument")
+
+    monkeypatch.setattr(video, "_VIDEO_CPUS", {1})
+    monkeypatch.setattr(video.os, "sched_setaffinity", setaffinity)
+    video._pin(threading.current_thread())
+
+
+def test_copyframe():
+    src = np.random.randint(0, 255, (49, 64, 3), dtype=np.uint8)
+    dst = np.zeros_like(src)
+    video._copyframe(dst, src)
+    assert np.array_equal(dst, src)
+
+
+def test_tie_file(opencvvideo, captures):
+    captures.append(FakeCapture(nframes=5))
+    sink = opencvvideo._hdmi_out
+    opencvvideo.start()
+    timeout = time.monotonic() + 5
+    while len(sink.values) < 12 and time.monotonic() < timeout:
+        time.sleep(0.01)
+    opencvvideo.stop()
+    assert not any(thread.is_alive() for thread in opencvvideo._threads)
+    values = sink.values
+    assert len(values) >= 12
+    assert values == [i % 5 for i in range(len(values))]